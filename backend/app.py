@@ -9,26 +9,129 @@ Expo Go Connection:
 """
 
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import uvicorn
+import io
 import os
-import tempfile
-from datetime import datetime
-from typing import List, Optional
+import time
+import orjson
+import asyncio
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+from typing import List, Optional, Tuple, Dict, Any, Iterable, BinaryIO
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.formparsers import MultiPartParser
+from bson import ObjectId
 
 # Import our services
-from database import MongoDB
-from face_service import FaceService
+from database import db, parse_timestamp
+from face_service import face_service
+
+
+def _json_default(obj: Any) -> Any:
+    """Serialize types orjson doesn't handle natively (MongoDB ObjectIds)."""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dump_json(content: Any) -> bytes:
+    """Encode content as JSON bytes with orjson."""
+    return orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response encoded with orjson, which is several times faster than the stdlib json module."""
+    
+    def render(self, content: Any) -> bytes:
+        return dump_json(content)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm up the face model before serving, in each worker process."""
+    await asyncio.to_thread(face_service.warmup)
+    yield
+    # Write attendance still waiting in the buffer before the worker exits
+    await asyncio.to_thread(db.flush_attendance)
 
 
 # Initialize FastAPI app
 app = FastAPI(
     title="Face Recognition Attendance API",
     description="API for student registration and attendance marking via face recognition",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=FastJSONResponse,
+    lifespan=lifespan
 )
 
+# Services are shared module-level instances, so the process has a single MongoDB client
+
+# Expo Go Connection Note:
+# Replace the MongoDB connection string in database.py for production
+# For local development, ensure MongoDB is running on localhost:27017
+
+# Faces are detected in worker threads; one worker per core so the CPU isn't oversubscribed
+DETECTION_WORKERS = os.cpu_count() or 1
+
+# Caps face detection and model calls across all requests in this process, so concurrent
+# requests can't run more at once than there are cores (or hold more batches in GPU memory)
+embedding_semaphore = asyncio.Semaphore(DETECTION_WORKERS)
+
+# Upload size limits: per image, and per request (a registration carries 10-20 images)
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", 25 * 1024 * 1024))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 200 * 1024 * 1024))
+
+# Each uploaded file is parsed into a SpooledTemporaryFile that stays in memory up to this size
+# and only then spills to disk. Starlette's 1 MB default sends most 1-3 MB phone photos to disk.
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", 8 * 1024 * 1024))
+MultiPartParser.spool_max_size = UPLOAD_SPOOL_BYTES
+
+# Uploads are copied into memory in chunks of this size
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Reject request bodies larger than max_bytes with a 413.
+    A declared Content-Length is checked before anything is read; otherwise (e.g. chunked
+    uploads) the body is counted as the form parser receives it, and parsing stops as soon as
+    the count passes the limit. A plain ASGI middleware, so responses are passed through untouched.
+    """
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        detail = f"Request body exceeds {self.max_bytes // (1024 * 1024)} MB"
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = FastJSONResponse(status_code=413, content={"detail": detail})
+            await response(scope, receive, send)
+            return
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # FastAPI re-raises HTTPExceptions from body parsing, so this becomes the response
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+
+# Added before CORS so CORS stays the outer layer and its headers reach the 413 responses too
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=MAX_UPLOAD_BYTES)
+
 # CORS middleware - CRITICAL for Expo Go
 app.add_middleware(
     CORSMiddleware,
@@ -38,13 +141,132 @@ app.add_middleware(
     allow_headers=["*"],   # Allow all headers
 )
 
-# Initialize services
-db = MongoDB()
-face_service = FaceService(db)
+def copy_upload(file: BinaryIO, limit: int) -> memoryview:
+    """Copy an upload into memory UPLOAD_CHUNK_BYTES at a time, reading at most limit + 1 bytes."""
+    buffer = io.BytesIO()
+    while buffer.tell() <= limit and (chunk := file.read(min(UPLOAD_CHUNK_BYTES, limit + 1 - buffer.tell()))):
+        buffer.write(chunk)
+    return buffer.getbuffer()
+
+
+async def read_upload(upload: UploadFile) -> memoryview:
+    """Read an uploaded image, refusing it as soon as it passes MAX_IMAGE_BYTES."""
+    too_large = HTTPException(status_code=413, detail=f"{upload.filename or 'Image'} exceeds {MAX_IMAGE_BYTES // (1024 * 1024)} MB")
+    if upload.size is not None and upload.size > MAX_IMAGE_BYTES:
+        raise too_large
+    
+    # One worker-thread hop for the whole copy, whether the upload is spooled in memory or on disk
+    content = await asyncio.to_thread(copy_upload, upload.file, MAX_IMAGE_BYTES)
+    if len(content) > MAX_IMAGE_BYTES:
+        raise too_large
+    return content
+
+
+def upload_names(uploads: List[UploadFile]) -> List[str]:
+    """Names recorded for uploaded images, since they are never written to disk."""
+    return [upload.filename or f"image_{i}" for i, upload in enumerate(uploads)]
+
+
+async def embed_uploads(uploads: List[UploadFile]) -> List[Any]:
+    """
+    Read uploads and generate their embeddings.
+    Face detection runs as a producer-consumer pipeline: each image's bytes are queued as soon
+    as they are read, so upload I/O overlaps with detection. The detected faces then go through
+    the model in batched calls. Returns one entry per upload: its embedding, or the Exception
+    that stopped it.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    results: List[Any] = [None] * len(uploads)
+    
+    async def detect_worker():
+        while (item := await queue.get()) is not None:
+            index, content = item
+            try:
+                async with embedding_semaphore:
+                    results[index] = await asyncio.to_thread(face_service.extract_face, content)
+            except Exception as e:
+                results[index] = e
+    
+    workers = [asyncio.create_task(detect_worker()) for _ in range(min(DETECTION_WORKERS, len(uploads)))]
+    try:
+        # Producer: read each upload and hand it straight to the workers
+        for index, upload in enumerate(uploads):
+            await queue.put((index, await read_upload(upload)))
+    finally:
+        # Signal end-of-stream and let the workers drain the queue
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    
+    detected = [index for index, result in enumerate(results) if not isinstance(result, Exception)]
+    if detected:
+        # One batched model pass for all detected faces
+        async with embedding_semaphore:
+            embeddings = await asyncio.to_thread(face_service.embed_faces, [results[index] for index in detected])
+        for index, embedding in zip(detected, embeddings):
+            results[index] = embedding
+    return results
+
+
+def check_timestamp(timestamp: str):
+    """Raise a 400 unless timestamp is an ISO 8601 date and time."""
+    try:
+        parse_timestamp(timestamp)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid timestamp (expected ISO 8601): {timestamp}")
+
+
+async def read_and_embed_uploads(uploads: List[UploadFile], image_names: List[str]) -> Tuple[list, List[Dict[str, Any]]]:
+    """Embed uploads, splitting the results into (embeddings, failed_images)."""
+    results = await embed_uploads(uploads)
+    embeddings = [result for result in results if not isinstance(result, Exception)]
+    failed_images = [
+        {"path": image_names[index], "error": str(result)}
+        for index, result in enumerate(results) if isinstance(result, Exception)
+    ]
+    return embeddings, failed_images
+
+async def json_list_response(fields: Dict[str, Any], key: str, items: Iterable[Dict[str, Any]]) -> StreamingResponse:
+    """
+    Stream a JSON object holding `fields`, a `key` list built item by item, and its "count".
+    Large lists are sent as they come off the database cursor instead of being built in memory.
+    """
+    items = iter(items)
+    # Fetch the first item now so database errors still surface before the response starts;
+    # the rest are pulled by StreamingResponse, which runs this sync generator in a threadpool
+    first = await asyncio.to_thread(next, items, None)
+    
+    def generate():
+        yield dump_json(fields)[:-1] + f',"{key}":['.encode()
+        count = 0
+        if first is not None:
+            yield dump_json(first)
+            count = 1
+            for item in items:
+                yield b"," + dump_json(item)
+                count += 1
+        yield f'],"count":{count}}}'.encode()
+    
+    return StreamingResponse(generate(), media_type="application/json")
+
+
+# /health is polled by load balancers, so its stats are cached briefly instead of hitting Mongo every time
+HEALTH_STATS_TTL = 5  # seconds
+_stats_cache: Dict[str, Any] = {"t": 0.0, "v": None}
+_stats_lock = asyncio.Lock()
+
+
+async def get_cached_stats() -> Dict[str, Any]:
+    """Return system stats, refreshing them at most once every HEALTH_STATS_TTL seconds."""
+    # The lock collapses concurrent refreshes into a single database round-trip
+    async with _stats_lock:
+        if _stats_cache["v"] is None or time.monotonic() - _stats_cache["t"] > HEALTH_STATS_TTL:
+            stats = await asyncio.to_thread(face_service.get_system_stats)
+            if not stats["success"]:
+                return stats  # Never cache a failure, so outages show up immediately
+            _stats_cache.update(t=time.monotonic(), v=stats)
+    return _stats_cache["v"]
 
-# Expo Go Connection Note:
-# Replace the MongoDB connection string in database.py for production
-# For local development, ensure MongoDB is running on localhost:27017
 
 @app.get("/")
 async def root():
@@ -63,7 +285,9 @@ async def test_endpoint():
 async def health_check():
     """Comprehensive health check"""
     try:
-        stats = face_service.get_system_stats()
+        stats = await get_cached_stats()
+        if not stats["success"]:
+            raise Exception(stats["error"])
         return {
             "status": "healthy",
             "database": "connected",
@@ -104,7 +328,6 @@ async def register_student(
     });
     ```
     """
-    temp_paths = []
     try:
         # Validate input
         if not images:
@@ -113,24 +336,18 @@ async def register_student(
         if len(images) < 3:
             raise HTTPException(status_code=400, detail="At least 3 images are recommended for reliable recognition")
         
-        # Save uploaded images to temporary files
-        for image in images:
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".jpg")
-            content = await image.read()
-            temp_file.write(content)
-            temp_file.close()
-            temp_paths.append(temp_file.name)
-        
-        # Register student using face service
-        result = face_service.register_student(name, student_id, temp_paths)
+        # Reject invalid or duplicate students before processing any images
+        error = await asyncio.to_thread(face_service.check_new_student, name, student_id)
+        if error:
+            raise HTTPException(status_code=400, detail=error["error"])
         
-        # Cleanup temporary files
-        for path in temp_paths:
-            if os.path.exists(path):
-                os.unlink(path)
+        # Read uploaded images and generate embeddings as they arrive, then register student
+        image_names = upload_names(images)
+        embeddings, failed_images = await read_and_embed_uploads(images, image_names)
+        result = await asyncio.to_thread(face_service.store_student, name, student_id, embeddings, image_names, failed_images)
         
         if result["success"]:
-            return JSONResponse(
+            return FastJSONResponse(
                 status_code=201,
                 content={
                     "success": True,
@@ -150,10 +367,6 @@ async def register_student(
     except HTTPException:
         raise
     except Exception as e:
-        # Cleanup on error
-        for path in temp_paths:
-            if os.path.exists(path):
-                os.unlink(path)
         raise HTTPException(status_code=500, detail=f"Registration failed: {str(e)}")
 
 @app.post("/attendance")
@@ -187,29 +400,22 @@ async def mark_attendance(
     }
     ```
     """
-    temp_path = None
     try:
         # Validate image
-        if not image.content_type.startswith('image/'): # type: ignore
+        if not (image.content_type or "").startswith('image/'):
             raise HTTPException(status_code=400, detail="Uploaded file must be an image")
         
-        # Save uploaded image to temporary file
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".jpg")
-        content = await image.read()
-        temp_file.write(content)
-        temp_file.close()
-        temp_path = temp_file.name
-        
-        # Use current timestamp if not provided
+        # Use current timestamp if not provided; reject a malformed one before any recognition
         if not timestamp:
-            timestamp = datetime.now().isoformat()
+            timestamp = datetime.now(timezone.utc).isoformat()
+        check_timestamp(timestamp)
         
-        # Mark attendance using face service
-        result = face_service.mark_attendance(temp_path, timestamp)
+        # Read uploaded image; it is decoded in memory by the face service
+        content = await read_upload(image)
         
-        # Cleanup temporary file
-        if temp_path and os.path.exists(temp_path):
-            os.unlink(temp_path)
+        # Mark attendance using face service
+        async with embedding_semaphore:
+            result = await asyncio.to_thread(face_service.mark_attendance, content, timestamp, image_path=image.filename)
         
         if result["success"]:
             if result["attendance_marked"]:
@@ -237,11 +443,67 @@ async def mark_attendance(
     except HTTPException:
         raise
     except Exception as e:
-        # Cleanup on error
-        if temp_path and os.path.exists(temp_path):
-            os.unlink(temp_path)
         raise HTTPException(status_code=500, detail=f"Attendance marking failed: {str(e)}")
 
+@app.post("/attendance/batch")
+async def mark_attendance_batch(
+    images: List[UploadFile] = File(..., description="Face images, one student per image"),
+    timestamp: Optional[str] = Form(None, description="Optional custom timestamp (ISO format)")
+):
+    """
+    Mark attendance for several students in one request.
+    
+    Expo Go Usage:
+    ```javascript
+    const formData = new FormData();
+    photos.forEach((photo, index) => {
+      formData.append('images', {
+        uri: photo.uri,
+        type: 'image/jpeg',
+        name: `student_${index}.jpg`
+      });
+    });
+    
+    const response = await fetch('http://your-server:8000/attendance/batch', {
+      method: 'POST',
+      body: formData,
+    });
+    
+    const result = await response.json();
+    result.results.forEach(r => {
+      if (r.attendance_marked) console.log(`Attendance marked for ${r.student.name}`);
+    });
+    ```
+    """
+    try:
+        # Validate images
+        for image in images:
+            if not (image.content_type or "").startswith('image/'):
+                raise HTTPException(status_code=400, detail=f"File {image.filename} is not an image")
+        
+        if not timestamp:
+            timestamp = datetime.now(timezone.utc).isoformat()
+        check_timestamp(timestamp)
+        
+        # Detect faces concurrently and embed them in one batched model call
+        embeddings = await embed_uploads(images)
+        
+        result = await asyncio.to_thread(face_service.mark_attendance_batch, embeddings, timestamp, upload_names(images))
+        
+        if result["success"]:
+            for item in result["results"]:
+                if "confidence" in item:
+                    item["confidence"] = round(item["confidence"], 4)
+            result["timestamp"] = timestamp
+            return result
+        else:
+            raise HTTPException(status_code=400, detail=result["error"])
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Batch attendance marking failed: {str(e)}")
+
 @app.get("/students")
 async def get_all_students():
     """
@@ -254,21 +516,9 @@ async def get_all_students():
     ```
     """
     try:
-        students = db.get_all_students()
-        return {
-            "success": True,
-            "count": len(students),
-            "students": [
-                {
-                    "id": student["id"],
-                    "name": student["name"],
-                    "student_id": student["student_id"],
-                    "image_count": student["image_count"],
-                    "is_active": student["is_active"]
-                }
-                for student in students
-            ]
-        }
+        # The projection happens in MongoDB, so documents are streamed out as they arrive
+        students = db.iter_all_students(fields=("name", "student_id", "image_count", "is_active"))
+        return await json_list_response({"success": True}, "students", students)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch students: {str(e)}")
 
@@ -285,13 +535,8 @@ async def get_attendance_by_date(date: str):
     ```
     """
     try:
-        records = db.get_attendance_by_date(date)
-        return {
-            "success": True,
-            "date": date,
-            "count": len(records),
-            "attendance": records
-        }
+        records = db.iter_attendance_by_date(date)
+        return await json_list_response({"success": True, "date": date}, "attendance", records)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch attendance: {str(e)}")
 
@@ -343,35 +588,14 @@ async def improve_recognition(
     });
     ```
     """
-    temp_paths = []
     try:
-        # Save uploaded images to temporary files
-        for image in images:
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".jpg")
-            content = await image.read()
-            temp_file.write(content)
-            temp_file.close()
-            temp_paths.append(temp_file.name)
-        
-        # Generate embeddings for new images
-        new_embeddings = []
-        failed_images = []
-        
-        for image_path in temp_paths:
-            try:
-                embedding = face_service.generate_embedding(image_path)
-                new_embeddings.append(embedding)
-            except Exception as e:
-                failed_images.append({"path": image_path, "error": str(e)})
+        # Read uploaded images and generate embeddings for them as they arrive
+        image_names = upload_names(images)
+        new_embeddings, failed_images = await read_and_embed_uploads(images, image_names)
         
         # Update student embeddings in database
         if new_embeddings:
-            success = db.update_student_embeddings(student_id, new_embeddings, temp_paths)
-            
-            # Cleanup
-            for path in temp_paths:
-                if os.path.exists(path):
-                    os.unlink(path)
+            success = await asyncio.to_thread(db.append_student_embeddings, student_id, new_embeddings, image_names)
             
             if success:
                 return {
@@ -388,23 +612,19 @@ async def improve_recognition(
     except HTTPException:
         raise
     except Exception as e:
-        # Cleanup on error
-        for path in temp_paths:
-            if os.path.exists(path):
-                os.unlink(path)
         raise HTTPException(status_code=500, detail=f"Recognition improvement failed: {str(e)}")
 
 # Error handlers
 @app.exception_handler(500)
 async def internal_server_error_handler(request, exc):
-    return JSONResponse(
+    return FastJSONResponse(
         status_code=500,
         content={"success": False, "error": "Internal server error"}
     )
 
 @app.exception_handler(404)
 async def not_found_handler(request, exc):
-    return JSONResponse(
+    return FastJSONResponse(
         status_code=404,
         content={"success": False, "error": "Endpoint not found"}
     )
@@ -413,30 +633,24 @@ async def not_found_handler(request, exc):
 @app.post("/check-face")
 async def check_face(image: UploadFile = File(...)):
     """Simple endpoint to check if face exists in database"""
-    temp_path = None
     try:
-        # Save uploaded image temporarily
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".jpg")
-        content = await image.read()
-        temp_file.write(content)
-        temp_file.close()
-        temp_path = temp_file.name
+        # Read uploaded image; it is decoded in memory by the face service
+        content = await read_upload(image)
         
         # Use existing face verification
-        result = face_service.verify_face(temp_path)
-        
-        # Cleanup
-        if temp_path and os.path.exists(temp_path):
-            os.unlink(temp_path)
+        async with embedding_semaphore:
+            result = await asyncio.to_thread(face_service.verify_face, content)
         
         return result
         
+    except HTTPException:
+        raise
     except Exception as e:
-        if temp_path and os.path.exists(temp_path):
-            os.unlink(temp_path)
         return {"success": False, "error": str(e)}
 
 if __name__ == "__main__":
+    # Single-process server for local development.
+    # In production run multiple workers with: gunicorn -c gunicorn_conf.py app:app
     print("🚀 Starting Face Recognition Attendance API Server...")
     print("📱 Expo Go can connect to: http://localhost:8000")
     print("📚 API Documentation: http://localhost:8000/docs")
@@ -11,13 +11,13 @@ Expo Go Connection:
 import argparse
 import sys
 from datetime import datetime, date
-from database import MongoDB
-from face_service import FaceService
+from database import db
+from face_service import face_service
 
 class AttendanceCLI:
     def __init__(self):
-        self.db = MongoDB()
-        self.face_service = FaceService(self.db)
+        self.db = db
+        self.face_service = face_service
     
     def show_stats(self):
         """Display system statistics"""
@@ -64,8 +64,12 @@ class AttendanceCLI:
             print(f"No attendance records found for {target_date}")
             return
         
+        # Look up every student on the list in one query
+        student_ids = {record['student_id'] for record in records}
+        students = {s['student_id']: s for s in self.db.get_students_in(student_ids, fields=("name", "student_id"))}
+        
         for i, record in enumerate(records, 1):
-            student = self.db.get_student_by_id(record['student_id'])
+            student = students.get(record['student_id'])
             student_name = student['name'] if student else "Unknown Student"
             print(f"{i:2d}. {student_name} (ID: {record['student_id']})")
             print(f"     Check-in: {record['check_in']}")
@@ -154,6 +158,22 @@ class AttendanceCLI:
             if len(student['image_paths']) > 5:
                 print(f"   ... and {len(student['image_paths']) - 5} more")
 
+    def migrate_embeddings(self):
+        """Convert embeddings stored in the older pickled format to quantised packed blobs"""
+        print("\n🔄 MIGRATING EMBEDDINGS")
+        print("=" * 40)
+        
+        migrated = self.db.migrate_legacy_embeddings()
+        print(f"✅ Migrated {migrated} students to packed embeddings")
+
+    def sync_vectors(self):
+        """Rebuild the vector search collection and index"""
+        print("\n🧭 SYNCING FACE VECTORS")
+        print("=" * 40)
+        
+        count = self.db.sync_face_vectors()
+        print(f"✅ Wrote {count} face vectors for vector search")
+
 def main():
     """Main CLI entry point"""
     parser = argparse.ArgumentParser(description="Attendance System CLI")
@@ -181,6 +201,12 @@ def main():
     detail_parser = subparsers.add_parser('student', help='Show student details')
     detail_parser.add_argument('student_id', help='Student ID to show')
     
+    # Migrate command
+    subparsers.add_parser('migrate-embeddings', help='Convert embeddings from older storage formats')
+    
+    # Vector search sync command
+    subparsers.add_parser('sync-vectors', help='Rebuild the Atlas Vector Search collection (needs VECTOR_SEARCH=1)')
+    
     args = parser.parse_args()
     
     if not args.command:
@@ -202,6 +228,10 @@ def main():
             cli.delete_student(args.student_id)
         elif args.command == 'student':
             cli.show_student_detail(args.student_id)
+        elif args.command == 'migrate-embeddings':
+            cli.migrate_embeddings()
+        elif args.command == 'sync-vectors':
+            cli.sync_vectors()
     except Exception as e:
         print(f"❌ Error: {str(e)}")
         sys.exit(1)
@@ -10,16 +10,122 @@ Expo Go Connection:
 
 import pymongo
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from pymongo.operations import SearchIndexModel
 import numpy as np
+from bson import ObjectId
 from bson.binary import Binary
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 import pickle
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterator, Iterable, Union
 from dotenv import load_dotenv
+from datetime import datetime, timezone
+import threading
+import logging
 import os
+from face_matching import unit_rows
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 mongo_url = os.getenv("MONGO_URL")
 
+# Connection pool limits for the shared MongoClient
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+
+# Student fields returned by listings; embeddings are left out
+STUDENT_FIELDS = ("name", "student_id", "image_count", "image_paths", "is_active", "created_at")
+
+# A student's embeddings are stored packed into one contiguous (N, D) blob of int8 codes, with
+# one float32 scale per row in "emb_scales". The rows are unit length, so matching is a plain
+# dot product. Older documents still hold an "embeddings" list of pickled numpy arrays instead;
+# those are normalised when read, until `python cli.py migrate-embeddings` rewrites them.
+EMB_DTYPE = np.dtype("<f4")
+EMB_CODE_DTYPE = np.dtype("i1")
+EMB_CODE_DTYPE_NAME = "int8"
+
+# Every field decode_embeddings() may need, across both formats
+EMBEDDING_FIELDS = ("embeddings_blob", "emb_scales", "emb_shape", "emb_dtype", "embeddings")
+
+
+def encode_embeddings(embeddings: Union[List[np.ndarray], np.ndarray]) -> Dict[str, Any]:
+    """Pack a student's embeddings into the document fields that store them."""
+    matrix = np.vstack(embeddings) if len(embeddings) else np.empty((0, 0))
+    matrix = unit_rows(matrix.astype(EMB_DTYPE))
+    
+    # Quantise each row to int8 with its own scale, so its largest component maps to +/-127
+    scales = np.abs(matrix).max(axis=1, initial=0)
+    scales = np.where(scales == 0, 1, scales / 127).astype(EMB_DTYPE)
+    codes = np.ascontiguousarray(np.round(matrix / scales[:, None]), dtype=EMB_CODE_DTYPE)
+    
+    # Stored uncompressed: int8 codes of unit vectors look like noise and barely compress
+    return {
+        "embeddings_blob": Binary(codes.tobytes()),
+        "emb_scales": Binary(scales.tobytes()),
+        "emb_shape": list(matrix.shape),
+        "emb_dtype": EMB_CODE_DTYPE_NAME
+    }
+
+
+def parse_timestamp(value: str) -> datetime:
+    """
+    Parse an ISO 8601 check-in time into an aware UTC datetime; raises ValueError if it isn't one.
+    A trailing "Z" is accepted, and times without an offset are taken as the server's local time.
+    """
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    return datetime.fromisoformat(value).astimezone(timezone.utc)
+
+
+def decode_embeddings(student: Dict) -> np.ndarray:
+    """Read a student document's embeddings as unit-length rows of an (N, D) array, in either stored format."""
+    if "embeddings_blob" in student:
+        codes = np.frombuffer(student["embeddings_blob"], dtype=EMB_CODE_DTYPE).reshape(student["emb_shape"])
+        scales = np.frombuffer(student["emb_scales"], dtype=EMB_DTYPE)
+        # Rounding nudges each row's length slightly, so dequantised rows are renormalised
+        return unit_rows(codes * scales[:, None])
+    
+    stored = student.get("embeddings") or []
+    if not stored:
+        return np.empty((0, 0), dtype=EMB_DTYPE)
+    return unit_rows(np.vstack([pickle.loads(emb) for emb in stored]).astype(EMB_DTYPE))
+
+
+# Optional MongoDB Atlas Vector Search: every stored embedding is mirrored as its own document
+# in the face_vectors collection, so the server can return the nearest faces from an index
+# instead of the app scanning them all. Run `python cli.py sync-vectors` once after enabling it.
+VECTOR_SEARCH = os.getenv("VECTOR_SEARCH", "").lower() in ("1", "true", "yes")
+VECTOR_SEARCH_INDEX = os.getenv("VECTOR_SEARCH_INDEX", "face_vector_index")
+VECTOR_SEARCH_CANDIDATES = int(os.getenv("VECTOR_SEARCH_CANDIDATES", "200"))
+
+# Students fetched per getMore while loading the gallery
+GALLERY_BATCH_SIZE = 500
+
+# Single attendance records are buffered and written together once this many are waiting,
+# or when ATTENDANCE_FLUSH_SECONDS have passed since the first one
+ATTENDANCE_FLUSH_SIZE = 100
+ATTENDANCE_FLUSH_SECONDS = 0.5
+
+
+_clients: Dict[str, MongoClient] = {}
+
+
+def get_client(connection_string: str) -> MongoClient:
+    """
+    Return the process-wide MongoClient for a connection string.
+    Every MongoClient runs its own connection pool and monitoring threads, so they are shared.
+    """
+    client = _clients.get(connection_string)
+    if client is None:
+        client = _clients[connection_string] = MongoClient(
+            connection_string,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE
+        )
+    return client
+
 
 class MongoDB:
     def __init__(self, connection_string: str = None, db_name: str = "attendance_system"): # type: ignore
@@ -32,14 +138,42 @@ class MongoDB:
         """
         if connection_string is None:
             connection_string = mongo_url
-        self.client = MongoClient(connection_string)
-        self.db = self.client[db_name]
-        self.students = self.db.students
-        self.attendance = self.db.attendance
+        self.connection_string = connection_string
+        self.db_name = db_name
+        self._connect()
+        
+        # Attendance records waiting for flush_attendance()
+        self._attendance_buffer: List[Dict[str, Any]] = []
+        self._attendance_lock = threading.Lock()
+        self._attendance_timer: Optional[threading.Timer] = None
         
         # Create indexes for better performance
         self.students.create_index("student_id", unique=True)
         self.attendance.create_index([("student_id", 1), ("date", 1)])
+        self.attendance.create_index([("date", 1), ("check_in", 1)])  # Attendance reports by date
+        if VECTOR_SEARCH:
+            self.face_vectors.create_index("student_id")
+    
+    def _connect(self):
+        self.client = get_client(self.connection_string)
+        self.db = self.client[self.db_name]
+        self.students = self.db.students
+        self.attendance = self.db.attendance
+        self.meta = self.db.meta
+        self.face_vectors = self.db.face_vectors
+    
+    def reconnect(self):
+        """
+        Replace the shared MongoDB client with a fresh one.
+        
+        MongoClient is not fork-safe: gunicorn workers call this after forking so they
+        don't share the connection pool opened by the master process (see gunicorn_conf.py).
+        The old client is dropped rather than closed, since its sockets belong to the parent.
+        Other MongoDB instances keep the old client until they reconnect too, which is why
+        the app uses the module-level `db`.
+        """
+        _clients.pop(self.connection_string, None)
+        self._connect()
     
     def add_student(self, name: str, student_id: str, embeddings: List[np.ndarray], image_paths: List[str] = None) -> str: # type: ignore
         """
@@ -49,36 +183,80 @@ class MongoDB:
         - This will be called when registering new students via the /register endpoint
         - embeddings are generated from multiple face images
         """
-        student_data = {
+        result = self.students.insert_one(self._student_document(name, student_id, embeddings, image_paths))
+        self._add_face_vectors(student_id, name, embeddings)
+        self._bump_embeddings_version()
+        return str(result.inserted_id)
+    
+    def add_students_bulk(self, students: List[Dict[str, Any]]) -> List[Optional[str]]:
+        """
+        Add several students with one insert_many.
+        Each entry holds the add_student() arguments: name, student_id, embeddings, image_paths.
+        Returns the database ID of each student, or None where it could not be inserted
+        (e.g. a duplicate student ID).
+        """
+        if not students:
+            return []
+        
+        documents = [self._student_document(**student) for student in students]
+        failed = set()
+        try:
+            # Unordered, so one rejected document doesn't stop the rest
+            self.students.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            failed = {error["index"] for error in e.details["writeErrors"]}
+        
+        if len(failed) < len(documents):
+            for i, student in enumerate(students):
+                if i not in failed:
+                    self._add_face_vectors(student["student_id"], student["name"], student["embeddings"])
+            self._bump_embeddings_version()
+        # insert_many sets _id on each document it inserts
+        return [None if i in failed else str(doc["_id"]) for i, doc in enumerate(documents)]
+    
+    def _student_document(self, name: str, student_id: str, embeddings: List[np.ndarray], image_paths: List[str] = None) -> Dict[str, Any]: # type: ignore
+        return {
             "name": name,
             "student_id": student_id,
-            "embeddings": [Binary(pickle.dumps(emb, protocol=2)) for emb in embeddings],
+            **encode_embeddings(embeddings),
             "image_count": len(embeddings),
             "image_paths": image_paths or [],
             "is_active": True,
             "created_at": None  # Will be set to current timestamp by MongoDB
         }
-        
-        result = self.students.insert_one(student_data)
-        return str(result.inserted_id)
     
     def get_student_by_id(self, student_id: str) -> Optional[Dict[str, Any]]:
         """Get student data by student ID."""
         student = self.students.find_one({"student_id": student_id})
         if student:
-            return self._deserialize_student(student)
+            return self._deserialize_student_full(student)
         return None
     
-    def get_all_students(self) -> List[Dict[str, Any]]:
+    def get_students_in(self, student_ids: Iterable[str], fields: Iterable[str] = STUDENT_FIELDS) -> List[Dict[str, Any]]:
+        """Get several students by student ID with a single query, without their embeddings."""
+        students = self.students.find({"student_id": {"$in": list(student_ids)}}, {field: 1 for field in fields})
+        return [{"id": str(student.pop("_id")), **student} for student in students]
+    
+    def get_all_students(self, fields: Iterable[str] = STUDENT_FIELDS) -> List[Dict[str, Any]]:
         """
-        Get all active students with their embeddings.
+        Get all active students, without their embeddings.
         
         Expo Go Connection:
-        - Used by face_service.py to compare against all registered students
-        - Returns list of all students for attendance marking
+        - Used for student listings and system statistics
+        - Face comparison loads embeddings through get_all_embeddings() instead
         """
-        students = self.students.find({"is_active": True})
-        return [self._deserialize_student(student) for student in students]
+        return list(self.iter_all_students(fields))
+    
+    def iter_all_students(self, fields: Iterable[str] = STUDENT_FIELDS) -> Iterator[Dict[str, Any]]:
+        """
+        Yield active students one at a time straight from the cursor.
+        Only `fields` (plus "id") are fetched, so the embeddings never leave MongoDB.
+        
+        Expo Go Connection:
+        - Lets /students stream its response instead of building the whole list first
+        """
+        for student in self.students.find({"is_active": True}, {field: 1 for field in fields}):
+            yield {"id": str(student.pop("_id")), **student}
     
     def get_all_embeddings(self) -> List[Dict[str, Any]]:
         """
@@ -88,22 +266,28 @@ class MongoDB:
         - Critical for face recognition during attendance marking
         - Returns all embeddings in a format easy for comparison
         """
-        students_data = []
-        for student in self.students.find({"is_active": True}):
-            student_data = self._deserialize_student(student)
-            students_data.append({
-                "student_id": student_data["student_id"],
-                "name": student_data["name"],
-                "embeddings": student_data["embeddings"]
-            })
-        return students_data
-    
-    def _deserialize_student(self, student: Dict) -> Dict[str, Any]:
+        # Only the fields the gallery needs, left as raw BSON until decode_embeddings reads them
+        students = self.students.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+        projection = {field: 1 for field in ("student_id", "name") + EMBEDDING_FIELDS}
+        projection["_id"] = 0
+        cursor = students.find({"is_active": True}, projection).batch_size(GALLERY_BATCH_SIZE)
+        
+        return [self._deserialize_student_embeddings_only(student) for student in cursor]
+    
+    def _deserialize_student_embeddings_only(self, student: Union[Dict, RawBSONDocument]) -> Dict[str, Any]:
+        """
+        Read just the name, ID and embeddings of a student document, ignoring any other fields.
+        Works on plain dicts and on the RawBSONDocuments read by get_all_embeddings().
+        """
+        return {
+            "student_id": student["student_id"],
+            "name": student["name"],
+            "embeddings": decode_embeddings(student)
+        }
+    
+    def _deserialize_student_full(self, student: Dict) -> Dict[str, Any]:
         """Convert MongoDB document to Python-friendly format."""
-        if 'embeddings' in student and student['embeddings']:
-            embeddings = [pickle.loads(emb) for emb in student['embeddings']]
-        else:
-            embeddings = []
+        embeddings = decode_embeddings(student)
             
         return {
             "id": str(student["_id"]),
@@ -124,17 +308,88 @@ class MongoDB:
         - Called when face recognition successfully identifies a student
         - check_in_time can be sent from frontend or generated on server
         - image_path can store the attendance image for verification
+        
+        The record is buffered and written with others in one insert (see flush_attendance()),
+        so its id is generated here rather than by the insert.
+        """
+        record = self._attendance_record(student_id, check_in_time, image_path)
+        record["_id"] = ObjectId()
+        
+        with self._attendance_lock:
+            self._attendance_buffer.append(record)
+            full = len(self._attendance_buffer) >= ATTENDANCE_FLUSH_SIZE
+            if not full and self._attendance_timer is None:
+                self._attendance_timer = threading.Timer(ATTENDANCE_FLUSH_SECONDS, self.flush_attendance)
+                self._attendance_timer.start()
+        
+        if full:
+            self.flush_attendance()
+        return str(record["_id"])
+    
+    def flush_attendance(self) -> int:
+        """
+        Write all buffered attendance records with one insert.
+        Returns how many were written. If the insert fails outright (e.g. a network error), the
+        records are kept for the next flush; records the server rejects individually are dropped.
+        """
+        with self._attendance_lock:
+            records, self._attendance_buffer = self._attendance_buffer, []
+            if self._attendance_timer is not None:
+                self._attendance_timer.cancel()
+                self._attendance_timer = None
+        
+        if not records:
+            return 0
+        
+        try:
+            self.attendance.insert_many(records, ordered=False)
+        except BulkWriteError as e:
+            # Unordered, so every other record was written. Duplicates were written by an earlier flush
+            # whose reply was lost; any other rejection would fail again on retry, so it is dropped
+            rejected = [error for error in e.details["writeErrors"] if error["code"] != 11000]
+            for error in rejected:
+                logger.error("Dropping attendance record %s: %s", records[error["index"]].get("_id"), error.get("errmsg"))
+            return len(records) - len(rejected)
+        except Exception as e:
+            self._requeue_attendance(records, e)
+            return 0
+        return len(records)
+    
+    def _requeue_attendance(self, records: List[Dict[str, Any]], error: Exception):
+        logger.error(f"Failed to write {len(records)} attendance records, will retry: {str(error)}")
+        with self._attendance_lock:
+            self._attendance_buffer[:0] = records
+            if self._attendance_timer is None:
+                self._attendance_timer = threading.Timer(ATTENDANCE_FLUSH_SECONDS, self.flush_attendance)
+                self._attendance_timer.start()
+    
+    def record_attendance_bulk(self, records: List[Dict[str, Any]]) -> List[str]:
         """
-        attendance_record = {
+        Record attendance for several students with one insert.
+        Each record holds the record_attendance() arguments: student_id, check_in_time, image_path.
+        
+        Expo Go Connection:
+        - Used by the /attendance/batch endpoint
+        """
+        if not records:
+            return []
+        
+        result = self.attendance.insert_many([
+            self._attendance_record(r["student_id"], r.get("check_in_time"), r.get("image_path"))
+            for r in records
+        ])
+        return [str(inserted_id) for inserted_id in result.inserted_ids]
+    
+    def _attendance_record(self, student_id: str, check_in_time: Optional[str], image_path: Optional[str]) -> Dict[str, Any]:
+        # check_in_time is an ISO format string; it is stored as a UTC datetime, dated in UTC too
+        check_in = parse_timestamp(check_in_time) if check_in_time else None
+        return {
             "student_id": student_id,
-            "check_in": check_in_time,  # Should be ISO format string
-            "date": check_in_time.split('T')[0] if check_in_time else None,  # Extract date part
+            "check_in": check_in,
+            "date": check_in.date().isoformat() if check_in else None,
             "image_path": image_path,
             "verified": True
         }
-        
-        result = self.attendance.insert_one(attendance_record)
-        return str(result.inserted_id)
     
     def get_attendance_by_date(self, date: str) -> List[Dict[str, Any]]:
         """
@@ -144,45 +399,81 @@ class MongoDB:
         - Useful for displaying attendance reports in your app
         - Date format: "YYYY-MM-DD"
         """
-        records = self.attendance.find({"date": date})
-        return [{
-            "id": str(record["_id"]),
-            "student_id": record["student_id"],
-            "check_in": record["check_in"],
-            "image_path": record.get("image_path")
-        } for record in records]
+        return list(self.iter_attendance_by_date(date))
+    
+    def iter_attendance_by_date(self, date: str) -> Iterator[Dict[str, Any]]:
+        """Yield attendance records for a date one at a time straight from the cursor."""
+        self.flush_attendance()  # Include records still waiting in this process's buffer
+        # Read datetimes back as aware UTC, so the returned ISO strings carry their offset
+        attendance = self.attendance.with_options(codec_options=CodecOptions(tz_aware=True))
+        for record in attendance.find({"date": date}).sort("check_in", 1):
+            check_in = record["check_in"]
+            yield {
+                "id": str(record["_id"]),
+                "student_id": record["student_id"],
+                "check_in": check_in.isoformat() if isinstance(check_in, datetime) else check_in,  # Older records hold strings
+                "image_path": record.get("image_path")
+            }
     
-    def update_student_embeddings(self, student_id: str, new_embeddings: List[np.ndarray], new_image_paths: List[str] = None) -> bool: # type: ignore
+    def append_student_embeddings(self, student_id: str, new_embeddings: List[np.ndarray], new_image_paths: List[str] = None) -> bool: # type: ignore
         """
-        Update or add more embeddings for an existing student.
+        Add more embeddings for an existing student.
+        The packed embedding blob is rewritten with the new rows appended.
         
         Expo Go Connection:
         - Useful for improving recognition accuracy by adding more training images
         - Can be called from an "improve recognition" feature in your app
         """
-        current_student = self.students.find_one({"student_id": student_id})
-        if not current_student:
-            return False
-        
-        # Combine existing and new embeddings
-        current_embeddings = [pickle.loads(emb) for emb in current_student.get('embeddings', [])]
-        all_embeddings = current_embeddings + new_embeddings
-        
-        current_paths = current_student.get('image_paths', [])
-        all_paths = current_paths + (new_image_paths or [])
-        
-        update_data = {
-            "embeddings": [Binary(pickle.dumps(emb, protocol=2)) for emb in all_embeddings],
-            "image_count": len(all_embeddings),
-            "image_paths": all_paths
-        }
-        
-        result = self.students.update_one(
-            {"student_id": student_id},
-            {"$set": update_data}
-        )
+        while True:
+            student = self.students.find_one(
+                {"student_id": student_id},
+                {"name": 1, "is_active": 1, **{field: 1 for field in EMBEDDING_FIELDS}}
+            )
+            if not student:
+                return False
+            
+            embeddings = decode_embeddings(student)
+            all_embeddings = [embeddings, *new_embeddings] if len(embeddings) else new_embeddings
+            packed = encode_embeddings(all_embeddings)
+            
+            # Only write if no other request appended to (or deleted) the student since we read it; otherwise retry
+            result = self.students.update_one(
+                {"_id": student["_id"], "emb_shape": student.get("emb_shape"), "is_active": student.get("is_active")},
+                {
+                    "$set": {**packed, "image_count": packed["emb_shape"][0]},
+                    "$push": {"image_paths": {"$each": new_image_paths or []}},
+                    "$unset": {"embeddings": ""}
+                }
+            )
+            if result.matched_count:
+                # Soft-deleted students keep their embeddings but must not become searchable again
+                if student.get("is_active"):
+                    self._add_face_vectors(student_id, student["name"], new_embeddings)
+                self._bump_embeddings_version()
+                return True
+    
+    def migrate_legacy_embeddings(self, student_id: str = None) -> int: # type: ignore
+        """
+        Rewrite embeddings stored in the older pickled format as quantised packed blobs.
+        Migrates every such student, or just student_id; returns how many were rewritten.
+        """
+        query: Dict[str, Any] = {"emb_dtype": {"$ne": EMB_CODE_DTYPE_NAME}}
+        if student_id is not None:
+            query["student_id"] = student_id
         
-        return result.modified_count > 0
+        migrated = 0
+        for student in self.students.find(query, {field: 1 for field in EMBEDDING_FIELDS}):
+            result = self.students.update_one(
+                {"_id": student["_id"], "emb_dtype": student.get("emb_dtype")},
+                {
+                    "$set": encode_embeddings(decode_embeddings(student)),
+                    "$unset": {"embeddings": ""}
+                }
+            )
+            migrated += result.modified_count
+        if migrated:
+            self._bump_embeddings_version()
+        return migrated
     
     def delete_student(self, student_id: str) -> bool:
         """Soft delete a student by setting is_active to False."""
@@ -190,10 +481,91 @@ class MongoDB:
             {"student_id": student_id},
             {"$set": {"is_active": False}}
         )
+        if result.modified_count:
+            if VECTOR_SEARCH:
+                self.face_vectors.delete_many({"student_id": student_id})
+            self._bump_embeddings_version()
         return result.modified_count > 0
     
+    def _add_face_vectors(self, student_id: str, name: str, embeddings: Union[List[np.ndarray], np.ndarray]):
+        """Mirror a student's new embeddings into face_vectors when vector search is enabled."""
+        if not VECTOR_SEARCH or not len(embeddings):
+            return
+        vectors = unit_rows(np.vstack(embeddings).astype(EMB_DTYPE))
+        self.face_vectors.insert_many([
+            {"student_id": student_id, "name": name, "vector": vector.tolist()}
+            for vector in vectors
+        ])
+    
+    def sync_face_vectors(self) -> int:
+        """
+        Rebuild face_vectors from the active students and create its vector search index if missing.
+        Returns the number of vectors written.
+        """
+        if not VECTOR_SEARCH:
+            raise ValueError("Vector search is disabled; set VECTOR_SEARCH=1 first")
+        
+        self.face_vectors.delete_many({})
+        count = 0
+        dimensions = None
+        for student in self.students.find({"is_active": True}, {"name": 1, "student_id": 1, **{field: 1 for field in EMBEDDING_FIELDS}}):
+            embeddings = decode_embeddings(student)
+            if len(embeddings):
+                self._add_face_vectors(student["student_id"], student["name"], embeddings)
+                count += len(embeddings)
+                dimensions = embeddings.shape[1]
+        
+        if dimensions and not list(self.face_vectors.list_search_indexes(VECTOR_SEARCH_INDEX)):
+            # Vectors are unit-length, so dot product equals cosine similarity
+            self.face_vectors.create_search_index(SearchIndexModel(
+                definition={"fields": [
+                    {"type": "vector", "path": "vector", "numDimensions": dimensions, "similarity": "dotProduct"}
+                ]},
+                name=VECTOR_SEARCH_INDEX,
+                type="vectorSearch"
+            ))
+        return count
+    
+    def vector_search(self, query: np.ndarray, limit: int = 5) -> List[Dict[str, Any]]:
+        """
+        Find the students closest to a unit-length query embedding with Atlas Vector Search.
+        Returns up to `limit` students, nearest first, with their best cosine distance.
+        """
+        pipeline = [
+            {"$vectorSearch": {
+                "index": VECTOR_SEARCH_INDEX,
+                "path": "vector",
+                "queryVector": query.astype(float).tolist(),
+                "numCandidates": VECTOR_SEARCH_CANDIDATES,
+                "limit": max(limit, VECTOR_SEARCH_CANDIDATES // 4)
+            }},
+            {"$project": {"student_id": 1, "name": 1, "score": {"$meta": "vectorSearchScore"}}},
+            # A student has several embeddings; keep their best one
+            {"$group": {"_id": "$student_id", "name": {"$first": "$name"}, "score": {"$max": "$score"}}},
+            {"$sort": {"score": -1}},
+            {"$limit": limit}
+        ]
+        # dotProduct scores are (1 + similarity) / 2, so the cosine distance is 2 - 2 * score
+        return [
+            {"student_id": match["_id"], "name": match["name"], "distance": 2.0 - 2.0 * match["score"]}
+            for match in self.face_vectors.aggregate(pipeline)
+        ]
+    
+    def get_embeddings_version(self) -> int:
+        """
+        Counter that changes whenever any stored embedding does.
+        Lets face_service.py keep the embeddings in memory and reload them only after a change.
+        """
+        counter = self.meta.find_one({"_id": "embeddings_version"})
+        return counter["v"] if counter else 0
+    
+    def _bump_embeddings_version(self):
+        self.meta.update_one({"_id": "embeddings_version"}, {"$inc": {"v": 1}}, upsert=True)
+    
     def close_connection(self):
-        """Close MongoDB connection."""
+        """Close MongoDB connection (shared by every MongoDB instance using the same URL)."""
+        self.flush_attendance()
+        _clients.pop(self.connection_string, None)
         self.client.close()
 
 
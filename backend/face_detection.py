@@ -0,0 +1,66 @@
+# face_detection.py
+"""
+Image decoding and face detection, kept apart from face_service.py so it can be imported
+without connecting to MongoDB. initial_setup.py runs it in worker processes.
+
+Expo Go Connection:
+- Not called by your frontend directly; face_service.py uses it for every uploaded image
+"""
+
+from deepface import DeepFace
+import numpy as np
+import cv2
+import os
+from typing import Any, Union
+
+# An image can be a file path, the encoded bytes of an uploaded image, or an already decoded BGR array
+ImageSource = Union[str, bytes, bytearray, memoryview, np.ndarray]
+
+
+def load_image(image: ImageSource) -> np.ndarray:
+    """
+    Decode an image into the BGR array DeepFace works on, exactly once.
+    Paths are read with cv2, encoded buffers are decoded in memory without touching disk,
+    and decoded arrays are passed through.
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    
+    if isinstance(image, str):
+        if not os.path.exists(image):
+            raise FileNotFoundError(f"Image not found: {image}")
+        decoded = cv2.imread(image, cv2.IMREAD_COLOR)
+        if decoded is None:
+            raise ValueError(f"Could not decode image: {image}")
+        return decoded
+    
+    decoded = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR) if len(image) else None
+    if decoded is None:
+        raise ValueError("Could not decode image data")
+    return decoded
+
+
+def detect_face(image: ImageSource, detector_backend: str) -> np.ndarray:
+    """
+    Detect and align the face in an image, returning the crop in BGR order.
+    """
+    face_objs = DeepFace.extract_faces(
+        img_path=load_image(image),
+        detector_backend=detector_backend,
+        enforce_detection=True
+    )
+    # extract_faces returns RGB; DeepFace.represent expects BGR like cv2
+    return face_objs[0]["face"][:, :, ::-1]
+
+
+def init_detection_worker(detector_backend: str):
+    """Load the face detector once per worker process instead of once per image."""
+    DeepFace.build_model(detector_backend, task="face_detector")
+
+
+def detect_face_worker(image_path: str, detector_backend: str) -> Any:
+    """Detect the face in one image; failures are returned, not raised, so one bad photo doesn't stop the map."""
+    try:
+        return detect_face(image_path, detector_backend)
+    except Exception as e:
+        return e
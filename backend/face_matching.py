@@ -0,0 +1,52 @@
+# face_matching.py
+"""
+Vector math for comparing face embeddings, kept apart from face_service.py and database.py so
+it can be imported (and tested) with nothing but numpy.
+
+Expo Go Connection:
+- Not called by your frontend directly; face_service.py and database.py use it
+"""
+
+import numpy as np
+import os
+
+# Optional compiled kernel for gallery distances: needs numba installed and NUMBA_MATCHING=1.
+# numpy's BLAS product is used otherwise.
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+NUMBA_MATCHING = njit is not None and os.getenv("NUMBA_MATCHING", "").lower() in ("1", "true", "yes")
+
+
+def unit_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scale each row (or a single vector) to unit length; all-zero rows are left as they are."""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+if njit is not None:
+    # Not parallel=True: requests call this from many threads at once, which numba's workqueue
+    # threading layer aborts on. nogil lets those concurrent calls run on separate cores instead.
+    @njit(cache=True, nogil=True, fastmath=True)
+    def _cosine_distances_kernel(matrix, query):
+        out = np.empty(matrix.shape[0], dtype=np.float32)
+        for i in range(matrix.shape[0]):
+            total = np.float32(0.0)
+            for j in range(matrix.shape[1]):
+                total += matrix[i, j] * query[j]
+            out[i] = 1.0 - total
+        return out
+
+
+def cosine_distances(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """
+    Cosine distance from a unit-length query to every row of a unit-normalised (N, D) matrix.
+    Uses the numba kernel for contiguous float32 inputs when NUMBA_MATCHING is on, and a
+    numpy matrix-vector product otherwise.
+    """
+    if (NUMBA_MATCHING and matrix.dtype == np.float32 and query.dtype == np.float32
+            and matrix.ndim == 2 and matrix.shape[1:] == query.shape
+            and matrix.flags.c_contiguous and query.flags.c_contiguous):
+        return _cosine_distances_kernel(matrix, query)
+    return 1.0 - matrix @ query
@@ -6,16 +6,27 @@ This handles the core face recognition logic for both registration and attendanc
 """
 
 from deepface import DeepFace
+from deepface.modules import preprocessing
 import numpy as np
 import os
+import threading
 from typing import List, Dict, Any, Tuple, Optional
-from database import MongoDB
+from database import MongoDB, VECTOR_SEARCH, db as shared_db
+from face_detection import ImageSource, detect_face
+from face_matching import unit_rows, cosine_distances
 import logging
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Largest number of faces sent through the model in one call; bounds GPU memory per batch
+MAX_BATCH = int(os.getenv("MAX_EMBEDDING_BATCH", "32"))
+
+# Students shortlisted by their centroid before their individual embeddings are compared
+CENTROID_CANDIDATES = int(os.getenv("CENTROID_CANDIDATES", "20"))
+
+
 class FaceService:
     def __init__(self, db: MongoDB = None, model_name: str = "Facenet"): # type: ignore
         """
@@ -25,116 +36,262 @@ class FaceService:
         - model_name can be "Facenet", "VGG-Face", "OpenFace", "DeepID", "ArcFace", "Dlib"
         - Facenet is recommended for good balance of accuracy and speed
         """
-        self.db = db or MongoDB()
+        self.db = db or shared_db  # One shared connection pool per process
         self.model_name = model_name
         self.detector_backend = "opencv"  # Alternatives: "mtcnn", "retinaface", "ssd"
         self.confidence_threshold = 0.6  # Adjust based on your accuracy needs
         
+        # Recognition model, built on first use (see the model property)
+        self._model = None
+        self._model_lock = threading.Lock()
+        
+        # (matrix, offsets, students, centroids) from build_gallery(), cached until the stored embeddings change
+        self._gallery = self.build_gallery([])
+        self._gallery_version: Optional[int] = None
+        self._gallery_lock = threading.Lock()
+        
         logger.info(f"FaceService initialized with model: {model_name}")
     
-    def generate_embedding(self, image_path: str) -> np.ndarray:
+    def warmup(self):
+        """
+        Load the detector and model weights and run one dummy inference.
+        
+        Expo Go Connection:
+        - Called once at server startup so the first /attendance or /register request
+          doesn't time out while the model loads
+        """
+        dummy = np.zeros((112, 112, 3), dtype=np.uint8)
+        DeepFace.extract_faces(img_path=dummy, detector_backend=self.detector_backend, enforce_detection=False)
+        self.embed_faces([dummy.astype(np.float32)])
+        cosine_distances(np.zeros((1, 1), dtype=np.float32), np.zeros(1, dtype=np.float32))  # Compiles the numba kernel, if enabled
+        logger.info(f"FaceService warmed up: {self.model_name} with {self.detector_backend} detector")
+    
+    @property
+    def model(self) -> Any:
+        """
+        The DeepFace recognition model, built once and reused for every embedding.
+        It is built lazily so processes that only import this module, like the detection
+        workers in initial_setup.py, don't load its weights.
+        """
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._model = DeepFace.build_model(self.model_name)
+        return self._model
+    
+    def generate_embedding(self, image: ImageSource) -> np.ndarray:
         """
         Generate face embedding from a single image.
         
         Expo Go Connection:
         - This is called for each image during student registration
         - Also called for the single image during attendance marking
+        - Accepts a file path or the raw bytes of an uploaded image
         """
+        image_name = image if isinstance(image, str) else "in-memory image"
         try:
-            # Verify image exists
-            if not os.path.exists(image_path):
-                raise FileNotFoundError(f"Image not found: {image_path}")
-            
-            # Generate embedding using DeepFace
-            embedding_objs = DeepFace.represent(
-                img_path=image_path,
-                model_name=self.model_name,
-                detector_backend=self.detector_backend,
-                enforce_detection=True
-            )
-            
-            if embedding_objs:
-                # Convert to numpy array
-                embedding = np.array(embedding_objs[0]['embedding'], dtype=np.float64) #type: ignore
-                logger.info(f"Successfully generated embedding from {image_path}")
-                return embedding
-            else:
-                raise Exception("No face detected in the image")
+            # Detect the face, then run it through the cached model
+            embedding = self.embed_faces([detect_face(image, self.detector_backend)])[0]
+            logger.info("Successfully generated embedding from %s", image_name)
+            return embedding
                 
         except Exception as e:
-            logger.error(f"Error generating embedding for {image_path}: {str(e)}")
+            logger.error("Error generating embedding for %s: %s", image_name, e)
             raise
     
-    def register_student(self, name: str, student_id: str, image_paths: List[str]) -> Dict[str, Any]:
+    def extract_face(self, image: ImageSource) -> np.ndarray:
         """
-        Register a new student with multiple face images.
-        
-        Expo Go Connection:
-        - Your frontend should capture 10-20 images and send them to /register endpoint
-        - This processes all images and stores embeddings in database
+        Detect and align the face in an image, without running the recognition model.
+        The crop is returned in BGR order, ready to be passed to embed_faces().
         """
+        image_name = image if isinstance(image, str) else "in-memory image"
         try:
-            # Validate inputs
-            if not name or not student_id:
-                return {"success": False, "error": "Name and student ID are required"}
-            
-            if not image_paths:
-                return {"success": False, "error": "At least one image is required"}
+            return detect_face(image, self.detector_backend)
             
-            # Check if student already exists
-            existing_student = self.db.get_student_by_id(student_id)
-            if existing_student:
-                return {"success": False, "error": f"Student ID {student_id} already exists"}
-            
-            successful_embeddings = []
-            failed_images = []
-            
-            # Process each image to generate embeddings
-            for i, image_path in enumerate(image_paths):
+        except Exception as e:
+            logger.error("Error extracting face from %s: %s", image_name, e)
+            raise
+    
+    def embed_faces(self, faces: List[np.ndarray]) -> List[np.ndarray]:
+        """
+        Generate embeddings for already-extracted faces, MAX_BATCH faces per model call.
+        
+        Expo Go Connection:
+        - /register and /improve-recognition detect faces per image, then embed them all at once
+        """
+        model = self.model
+        # Same preprocessing as DeepFace.represent(); input_shape is (width, height)
+        target_size = (model.input_shape[1], model.input_shape[0])
+        
+        embeddings = []
+        for start in range(0, len(faces), MAX_BATCH):
+            batch = np.concatenate([
+                preprocessing.normalize_input(preprocessing.resize_image(face, target_size), normalization="base")
+                for face in faces[start:start + MAX_BATCH]
+            ])
+            # forward() returns a flat list for a single face, so reshape to one row per face
+            output = np.asarray(model.forward(batch), dtype=np.float32).reshape(len(batch), -1)
+            embeddings.extend(output)
+        
+        logger.info(f"Generated {len(embeddings)} embeddings in batches of up to {MAX_BATCH}")
+        return embeddings
+    
+    def generate_embeddings_batch(self, images: List[ImageSource]) -> List[Any]:
+        """
+        Generate embeddings for several images with batched model calls.
+        Returns one entry per image: its embedding, or the exception if no face was found,
+        so one bad photo doesn't fail the whole batch.
+        Images are handled MAX_BATCH at a time, so only one batch of face crops is held in memory.
+        """
+        results: List[Any] = []
+        for start in range(0, len(images), MAX_BATCH):
+            detected = []
+            for image in images[start:start + MAX_BATCH]:
                 try:
-                    embedding = self.generate_embedding(image_path)
-                    successful_embeddings.append(embedding)
-                    logger.info(f"Processed image {i+1}/{len(image_paths)} successfully")
-                    
+                    detected.append(self.extract_face(image))
                 except Exception as e:
-                    failed_images.append({
-                        'path': image_path,
-                        'error': str(e)
-                    })
-                    logger.warning(f"Failed to process image {i+1}: {str(e)}")
-            
+                    detected.append(e)
+            results.extend(self.embed_detected(detected))
+        return results
+    
+    def embed_detected(self, detected: List[Any]) -> List[Any]:
+        """
+        Embed a list of detection results: face crops are replaced by their embeddings,
+        exceptions for images where detection failed are passed through.
+        """
+        embeddings = iter(self.embed_faces([face for face in detected if not isinstance(face, Exception)]))
+        return [face if isinstance(face, Exception) else next(embeddings) for face in detected]
+    
+    def check_new_student(self, name: str, student_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Validate a registration request before any images are processed.
+        Returns an error result, or None if the student can be registered.
+        """
+        if not name or not student_id:
+            return {"success": False, "error": "Name and student ID are required"}
+        
+        # Check if student already exists
+        existing_student = self.db.get_student_by_id(student_id)
+        if existing_student:
+            return {"success": False, "error": f"Student ID {student_id} already exists"}
+        
+        return None
+    
+    def check_embeddings(self, embeddings: List[np.ndarray], failed_images: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Return an error result if too few images produced an embedding, or None."""
+        if len(embeddings) < 3:  # Minimum 3 images for reliable recognition
+            return {
+                "success": False, 
+                "error": f"Only {len(embeddings)} images processed successfully. Need at least 3.",
+                "failed_images": failed_images
+            }
+        return None
+    
+    def _stored_result(self, name: str, student_id: str, db_id: str, embeddings: List[np.ndarray], image_paths: List[str], failed_images: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return {
+            "success": True,
+            "student_id": student_id,
+            "name": name,
+            "db_id": db_id,
+            "total_images": len(image_paths),
+            "successful_embeddings": len(embeddings),
+            "failed_images": failed_images,
+            "message": f"Student registered with {len(embeddings)} face embeddings"
+        }
+    
+    def store_student(self, name: str, student_id: str, embeddings: List[np.ndarray], image_paths: List[str], failed_images: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Store a new student from embeddings that have already been generated.
+        
+        Expo Go Connection:
+        - /register generates embeddings concurrently, then calls this to save them
+        """
+        try:
             # Check if we have enough successful embeddings
-            if len(successful_embeddings) < 3:  # Minimum 3 images for reliable recognition
-                return {
-                    "success": False, 
-                    "error": f"Only {len(successful_embeddings)} images processed successfully. Need at least 3.",
-                    "failed_images": failed_images
-                }
+            error = self.check_embeddings(embeddings, failed_images)
+            if error:
+                return error
             
             # Store student data in database
             student_db_id = self.db.add_student(
                 name=name,
                 student_id=student_id,
-                embeddings=successful_embeddings,
+                embeddings=embeddings,
                 image_paths=image_paths
             )
             
-            return {
-                "success": True,
-                "student_id": student_id,
-                "name": name,
-                "db_id": student_db_id,
-                "total_images": len(image_paths),
-                "successful_embeddings": len(successful_embeddings),
-                "failed_images": failed_images,
-                "message": f"Student registered with {len(successful_embeddings)} face embeddings"
-            }
+            return self._stored_result(name, student_id, student_db_id, embeddings, image_paths, failed_images)
             
         except Exception as e:
             logger.error(f"Error registering student {student_id}: {str(e)}")
             return {"success": False, "error": str(e)}
     
-    def verify_face(self, image_path: str) -> Dict[str, Any]:
+    def store_students(self, students: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Store several new students with a single database insert.
+        Each entry holds the store_student() arguments; returns one store_student()-style
+        result per entry.
+        """
+        results: List[Any] = [self.check_embeddings(s['embeddings'], s['failed_images']) for s in students]
+        valid = [i for i, error in enumerate(results) if error is None]
+        
+        try:
+            db_ids = self.db.add_students_bulk([
+                {key: students[i][key] for key in ('name', 'student_id', 'embeddings', 'image_paths')}
+                for i in valid
+            ])
+        except Exception as e:
+            logger.error(f"Error registering students: {str(e)}")
+            db_ids = [None] * len(valid)
+        
+        for i, db_id in zip(valid, db_ids):
+            student = students[i]
+            if db_id is not None:
+                results[i] = self._stored_result(
+                    student['name'], student['student_id'], db_id,
+                    student['embeddings'], student['image_paths'], student['failed_images']
+                )
+            else:
+                results[i] = {"success": False, "error": f"Student {student['student_id']} could not be stored"}
+        return results
+    
+    def register_student(self, name: str, student_id: str, images: List[ImageSource], image_paths: List[str] = None) -> Dict[str, Any]: # type: ignore
+        """
+        Register a new student with multiple face images.
+        
+        Expo Go Connection:
+        - Your frontend should capture 10-20 images and send them to /register endpoint
+        - This processes all images and stores embeddings in database
+        - images may be in-memory buffers; image_paths then names them for storage
+        """
+        try:
+            if image_paths is None:
+                image_paths = [image if isinstance(image, str) else f"image_{i}" for i, image in enumerate(images)]
+            
+            # Validate inputs
+            error = self.check_new_student(name, student_id)
+            if error:
+                return error
+            
+            if not images:
+                return {"success": False, "error": "At least one image is required"}
+            
+            # Process all images in batched model calls
+            results = self.generate_embeddings_batch(images)
+            successful_embeddings = [result for result in results if not isinstance(result, Exception)]
+            failed_images = [
+                {'path': image_path, 'error': str(result)}
+                for image_path, result in zip(image_paths, results) if isinstance(result, Exception)
+            ]
+            logger.info(f"Processed {len(successful_embeddings)}/{len(images)} images successfully")
+            
+            return self.store_student(name, student_id, successful_embeddings, image_paths, failed_images)
+            
+        except Exception as e:
+            logger.error(f"Error registering student {student_id}: {str(e)}")
+            return {"success": False, "error": str(e)}
+    
+    def verify_face(self, image: ImageSource) -> Dict[str, Any]:
         """
         Verify a face against all registered students.
         
@@ -144,59 +301,33 @@ class FaceService:
         """
         try:
             # Generate embedding for the input image
-            input_embedding = self.generate_embedding(image_path)
+            input_embedding = self.generate_embedding(image)
             
-            # Get all registered students with their embeddings
-            all_students = self.db.get_all_embeddings()
+            # Find the closest registered students
+            all_distances = self.nearest_students(unit_rows(input_embedding.astype(np.float32, copy=False)))
             
-            if not all_students:
+            if not all_distances:
                 return {
                     "success": True,
                     "matched": False,
                     "error": "No students registered in the system"
                 }
             
-            best_match = None
-            best_distance = float('inf')
-            all_distances = []
-            
-            # Compare with all registered students
-            for student in all_students:
-                student_distances = []
-                
-                # Compare with each embedding of the student
-                for stored_embedding in student['embeddings']:
-                    distance = self.cosine_distance(input_embedding, stored_embedding)
-                    student_distances.append(distance)
-                
-                # Use the best (minimum) distance for this student
-                min_student_distance = min(student_distances)
-                all_distances.append({
-                    'student_id': student['student_id'],
-                    'name': student['name'],
-                    'distance': min_student_distance
-                })
-                
-                if min_student_distance < best_distance:
-                    best_distance = min_student_distance
-                    best_match = {
-                        'student_id': student['student_id'],
-                        'name': student['name'],
-                        'distance': min_student_distance
-                    }
+            best_match = all_distances[0]
+            best_distance = best_match['distance']
             
             # Calculate confidence (inverse of distance)
             confidence = 1 - best_distance
             
             # Check if best match meets confidence threshold
-            if best_match and best_distance <= self.confidence_threshold:
+            if best_distance <= self.confidence_threshold:
                 return {
                     "success": True,
                     "matched": True,
                     "student": best_match,
                     "confidence": confidence,
                     "distance": best_distance,
-                    "all_matches": sorted(all_distances, key=lambda x: x['distance'])[:5]  # Top 5 matches
+                    "all_matches": all_distances
                 }
             else:
                 return {
@@ -205,7 +336,7 @@ class FaceService:
                     "best_match": best_match,
                     "confidence": confidence,
                     "distance": best_distance,
-                    "all_matches": sorted(all_distances, key=lambda x: x['distance'])[:5],
+                    "all_matches": all_distances,
                     "message": "No confident match found"
                 }
                 
@@ -213,7 +344,7 @@ class FaceService:
             logger.error(f"Error verifying face: {str(e)}")
             return {"success": False, "error": str(e)}
     
-    def mark_attendance(self, image_path: str, timestamp: str = None) -> Dict[str, Any]: #type: ignore
+    def mark_attendance(self, image: ImageSource, timestamp: str = None, image_path: str = None) -> Dict[str, Any]: #type: ignore
         """
         Mark attendance by verifying face and recording in database.
         
@@ -222,8 +353,11 @@ class FaceService:
         - Returns detailed result for frontend display
         """
         try:
+            if image_path is None and isinstance(image, str):
+                image_path = image
+            
             # Verify the face
-            verification_result = self.verify_face(image_path)
+            verification_result = self.verify_face(image)
             
             if not verification_result['success']:
                 return verification_result
@@ -264,13 +398,150 @@ class FaceService:
         except Exception as e:
             logger.error(f"Error marking attendance: {str(e)}")
             return {"success": False, "error": str(e)}
+
+    def build_gallery(self, all_students: List[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray, List[Dict[str, str]], np.ndarray]:
+        """
+        Stack every stored embedding into one unit-normalised (N, D) matrix for vectorised matching.
+        Returns (matrix, offsets, students, centroids): the rows of students[i] start at offsets[i],
+        and centroids[i] is the unit-length mean of those rows.
+        """
+        students = [student for student in all_students if len(student['embeddings'])]
+        if not students:
+            empty = np.empty((0, 0), dtype=np.float32)
+            return empty, np.empty(0, dtype=np.intp), [], empty
+        
+        # Stored embeddings are already unit-length (see database.py)
+        matrix = np.vstack([student['embeddings'] for student in students]).astype(np.float32, copy=False)
+        counts = np.array([len(student['embeddings']) for student in students])
+        offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        centroids = unit_rows(np.add.reduceat(matrix, offsets))
+        return matrix, offsets, [{'student_id': s['student_id'], 'name': s['name']} for s in students], centroids
+    
+    def nearest_students(self, query: np.ndarray, k: int = 5) -> List[Dict[str, Any]]:
+        """
+        Return the k students closest to a unit-length query embedding, nearest first,
+        each with their best cosine distance.
+        Uses Atlas Vector Search when it is enabled, and the in-memory gallery otherwise
+        or if the search fails (e.g. its index is still building).
+        """
+        if VECTOR_SEARCH:
+            try:
+                return self.db.vector_search(query, k)
+            except Exception as e:
+                logger.warning(f"Vector search failed, matching in memory instead: {str(e)}")
+        
+        matrix, offsets, students, centroids = self.load_gallery()
+        if not students:
+            return []
+        
+        candidates = np.arange(len(students))
+        if len(students) > CENTROID_CANDIDATES:
+            # Shortlist students by their centroid, then only compare their own embeddings
+            candidates = np.argpartition(cosine_distances(centroids, query), CENTROID_CANDIDATES - 1)[:CENTROID_CANDIDATES]
+            counts = np.diff(offsets, append=len(matrix))[candidates]
+            matrix = matrix[np.concatenate([np.arange(offsets[i], offsets[i] + n) for i, n in zip(candidates, counts)])]
+            offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        
+        # One matrix-vector product against the candidates' embeddings,
+        # then the best (minimum) distance per student
+        distances = np.minimum.reduceat(cosine_distances(matrix, query), offsets)
+        
+        # Select the k nearest in linear time, then sort just those
+        if k < len(distances):
+            nearest = np.argpartition(distances, k - 1)[:k]
+        else:
+            nearest = np.arange(len(distances))
+        nearest = nearest[np.argsort(distances[nearest])]
+        return [
+            {**students[candidates[i]], 'distance': float(distances[i])}
+            for i in nearest
+        ]
+    
+    def load_gallery(self) -> Tuple[np.ndarray, np.ndarray, List[Dict[str, str]], np.ndarray]:
+        """
+        Return the gallery used for matching (see build_gallery()).
+        It is kept in memory and only reloaded from the database when the embeddings version
+        has changed, which also picks up students registered by other processes.
+        """
+        # Read the version before the embeddings, so a concurrent write can only make the cache newer
+        version = self.db.get_embeddings_version()
+        with self._gallery_lock:
+            if version != self._gallery_version:
+                self._gallery = self.build_gallery(self.db.get_all_embeddings())
+                self._gallery_version = version
+                logger.info(f"Loaded {len(self._gallery[2])} students into the face gallery (version {version})")
+            return self._gallery
+    
+    def mark_attendance_batch(self, embeddings: List[Any], timestamp: str = None, image_paths: List[str] = None) -> Dict[str, Any]: # type: ignore
+        """
+        Mark attendance for several face images at once.
+        embeddings holds one entry per image, as returned by generate_embeddings_batch():
+        an embedding, or the exception that stopped that image.
+        
+        Expo Go Connection:
+        - Called by /attendance/batch so a whole class can be marked in one request
+        - All faces are matched with a single matrix product and recorded with one insert
+        """
+        try:
+            if image_paths is None:
+                image_paths = [f"image_{i}" for i in range(len(embeddings))]
+            
+            matrix, offsets, students, _ = self.load_gallery()
+            if not students:
+                return {"success": False, "error": "No students registered in the system"}
+            
+            results: List[Dict[str, Any]] = [{"image": path} for path in image_paths]
+            valid = []
+            for i, embedding in enumerate(embeddings):
+                if isinstance(embedding, Exception):
+                    results[i].update(attendance_marked=False, error=str(embedding))
+                else:
+                    valid.append(i)
+            
+            matched = []
+            if valid:
+                queries = unit_rows(np.vstack([embeddings[i] for i in valid]).astype(np.float32, copy=False))
+                
+                # One (B, N) matmul, then each student's closest embedding per query
+                distances = np.minimum.reduceat(1.0 - queries @ matrix.T, offsets, axis=1)
+                best = distances.argmin(axis=1)
+                
+                for row, i in enumerate(valid):
+                    student = students[best[row]]
+                    distance = float(distances[row, best[row]])
+                    results[i].update(confidence=1 - distance, distance=distance)
+                    if distance <= self.confidence_threshold:
+                        results[i].update(attendance_marked=True, student=student)
+                        matched.append(i)
+                    else:
+                        results[i].update(attendance_marked=False, best_match=student)
+            
+            # Record every match in a single round-trip
+            attendance_ids = self.db.record_attendance_bulk([
+                {"student_id": results[i]["student"]["student_id"], "check_in_time": timestamp, "image_path": image_paths[i]}
+                for i in matched
+            ])
+            for i, attendance_id in zip(matched, attendance_ids):
+                results[i]["attendance_id"] = attendance_id
+            
+            return {
+                "success": True,
+                "marked_count": len(matched),
+                "results": results,
+                "message": f"Attendance marked for {len(matched)} of {len(embeddings)} images"
+            }
+        
+        except Exception as e:
+            logger.error(f"Error marking batch attendance: {str(e)}")
+            return {"success": False, "error": str(e)}
     
     def cosine_distance(self, emb1: np.ndarray, emb2: np.ndarray) -> float:
         """
-        Calculate cosine distance between two embeddings.
+        Calculate cosine distance between two unit-length embeddings.
         Lower distance = more similar faces.
+        Stored embeddings are unit-length; normalise a fresh one with unit_rows() first.
         """
-        return 1 - np.dot(emb1, emb2) / (np.linalg.norm(emb1) * np.linalg.norm(emb2))
+        return 1.0 - float(np.dot(emb1, emb2))
     
     def get_system_stats(self) -> Dict[str, Any]:
         """
@@ -280,7 +551,7 @@ class FaceService:
         - Can be called from an admin dashboard in your app
         """
         try:
-            all_students = self.db.get_all_students()
+            all_students = self.db.get_all_students(fields=("image_count",))
             total_students = len(all_students)
             total_embeddings = sum(student['image_count'] for student in all_students)
             
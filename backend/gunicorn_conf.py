@@ -0,0 +1,31 @@
+# gunicorn_conf.py
+"""
+Gunicorn settings for running the API with several Uvicorn worker processes.
+Embedding generation is CPU-bound, so separate processes let /attendance bursts
+run in parallel instead of queueing behind one interpreter. Each worker loads its own
+TensorFlow and face model, and TensorFlow already spreads one inference over several
+cores, so the default is one worker per two cores; set WEB_CONCURRENCY to tune it.
+
+Usage (from the backend directory):
+    gunicorn -c gunicorn_conf.py app:app
+
+Expo Go Connection:
+- Nothing changes for the app: it still connects to http://your-server-ip:8000
+"""
+
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.environ.get("WEB_CONCURRENCY", max(1, (os.cpu_count() or 1) // 2)))
+timeout = 60
+
+# Import the app in the master so import errors stop startup before any worker is forked.
+# The face model is not shared: it is built and warmed up in each worker (see app.lifespan).
+preload_app = True
+
+
+def post_fork(server, worker):
+    """Give each worker its own MongoDB connection pool; MongoClient is not fork-safe."""
+    import app
+    app.db.reconnect()
@@ -11,8 +11,10 @@ Expo Go Connection:
 
 import os
 import glob
-from database import MongoDB
-from face_service import FaceService
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from face_detection import init_detection_worker, detect_face_worker
 import logging
 from typing import List, Dict, Any
 
@@ -20,10 +22,18 @@ from typing import List, Dict, Any
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Face detection is CPU-bound, so it runs in one worker process per core
+DETECTION_WORKERS = os.cpu_count() or 1
+
+
 class InitialSetup:
     def __init__(self):
-        self.db = MongoDB()
-        self.face_service = FaceService(self.db)
+        # Imported here rather than at module level: spawned detection workers re-import this
+        # module, and must not each open a MongoDB connection and create indexes
+        from database import db
+        from face_service import face_service
+        self.db = db
+        self.face_service = face_service
         self.students_dir = "students"  # Change this if your directory is elsewhere
         
     def discover_students(self) -> List[Dict[str, Any]]:
@@ -54,6 +64,7 @@ class InitialSetup:
         
         logger.info(f"Found {len(student_folders)} student folders: {student_folders}")
         
+        empty_folders = []
         for folder in student_folders:
             folder_path = os.path.join(self.students_dir, folder)
             
@@ -70,11 +81,9 @@ class InitialSetup:
                 image_paths.extend(glob.glob(os.path.join(folder_path, extension)))
             
             if not image_paths:
-                logger.warning(f"No images found in {folder_path}")
+                empty_folders.append(folder_path)
                 continue
             
-            logger.info(f"Found {len(image_paths)} images for {student_name}")
-            
             students_data.append({
                 'name': student_name,
                 'student_id': student_id,
@@ -82,34 +91,58 @@ class InitialSetup:
                 'image_paths': image_paths
             })
         
+        # One summary instead of a log line per folder
+        if empty_folders:
+            logger.warning("No images found in %d folders: %s", len(empty_folders), empty_folders)
+        logger.info("Found %d images for %d students",
+                    sum(len(student['image_paths']) for student in students_data), len(students_data))
+        
         return students_data
     
-    def register_student_batch(self, student_data: Dict[str, Any]) -> Dict[str, Any]:
+    def embed_all_students(self, students_data: List[Dict[str, Any]]) -> List[List[Any]]:
         """
-        Register a single student with all their images.
+        Generate embeddings for every student's images.
+        Faces are detected in parallel worker processes, and the crops go through the model
+        in batched calls. Returns, per student, one embedding (or the exception that stopped it)
+        per image.
         """
-        try:
-            logger.info(f"Registering {student_data['name']} with {len(student_data['image_paths'])} images...")
-            
-            # Use the face service to register the student
-            result = self.face_service.register_student(
-                name=student_data['name'],
-                student_id=student_data['student_id'],
-                image_paths=student_data['image_paths']
-            )
-            
-            if result['success']:
-                logger.info(f"✅ SUCCESS: {student_data['name']} registered with {result['successful_embeddings']} embeddings")
-                if result['failed_images']:
-                    logger.warning(f"   {len(result['failed_images'])} images failed for {student_data['name']}")
-            else:
-                logger.error(f"❌ FAILED: {student_data['name']} - {result['error']}")
-            
-            return result
-            
-        except Exception as e:
-            logger.error(f"❌ ERROR registering {student_data['name']}: {str(e)}")
-            return {'success': False, 'error': str(e)}
+        image_paths = [path for student_data in students_data for path in student_data['image_paths']]
+        logger.info(f"Generating embeddings for {len(image_paths)} images with {DETECTION_WORKERS} detection workers...")
+        
+        from face_service import MAX_BATCH
+        results: List[Any] = []
+        detector_backend = self.face_service.detector_backend
+        # Spawned rather than forked: TensorFlow in this process is not fork-safe
+        with ProcessPoolExecutor(
+            max_workers=DETECTION_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_detection_worker,
+            initargs=(detector_backend,)
+        ) as pool:
+            # A few batches at a time, so face crops for the whole directory are never held at once
+            step = MAX_BATCH * DETECTION_WORKERS
+            for start in range(0, len(image_paths), step):
+                chunk = image_paths[start:start + step]
+                detected = list(pool.map(detect_face_worker, chunk, repeat(detector_backend), chunksize=4))
+                results.extend(self.face_service.embed_detected(detected))
+        
+        results_iter = iter(results)
+        return [[next(results_iter) for _ in student_data['image_paths']] for student_data in students_data]
+    
+    def collect_student(self, student_data: Dict[str, Any], embeddings: List[Any]) -> Dict[str, Any]:
+        """
+        Split a student's image results into the store_student() arguments.
+        """
+        return {
+            'name': student_data['name'],
+            'student_id': student_data['student_id'],
+            'embeddings': [e for e in embeddings if not isinstance(e, Exception)],
+            'image_paths': student_data['image_paths'],
+            'failed_images': [
+                {'path': path, 'error': str(e)}
+                for path, e in zip(student_data['image_paths'], embeddings) if isinstance(e, Exception)
+            ]
+        }
     
     def run_initial_setup(self):
         """
@@ -132,14 +165,35 @@ class InitialSetup:
         total_failed = 0
         results = []
         
-        # Process each student
+        # Skip students that can't be registered before spending time on their images
+        pending = []
         for student_data in students_data:
-            result = self.register_student_batch(student_data)
+            error = self.face_service.check_new_student(student_data['name'], student_data['student_id'])
+            if error:
+                logger.error("FAILED: %s - %s", student_data['name'], error['error'])
+                results.append(error)
+                total_failed += 1
+            else:
+                pending.append(student_data)
+        
+        # Embed every image in one batched pass, then store all students with one insert
+        embeddings = self.embed_all_students(pending)
+        stored = self.face_service.store_students([
+            self.collect_student(student_data, student_embeddings)
+            for student_data, student_embeddings in zip(pending, embeddings)
+        ])
+        
+        # Per-student successes only go to the debug log; the summary below counts them
+        failed_images = 0
+        for student_data, result in zip(pending, stored):
             results.append(result)
             
             if result['success']:
+                logger.debug("Registered %s with %d embeddings", student_data['name'], result['successful_embeddings'])
+                failed_images += len(result['failed_images'])
                 total_success += 1
             else:
+                logger.error("FAILED: %s - %s", student_data['name'], result['error'])
                 total_failed += 1
         
         # Print summary
@@ -149,6 +203,8 @@ class InitialSetup:
         logger.info(f"✅ Successfully registered: {total_success} students")
         logger.info(f"❌ Failed to register: {total_failed} students")
         logger.info(f"📁 Total processed: {len(students_data)} students")
+        if failed_images:
+            logger.warning(f"⚠️ Images skipped for registered students: {failed_images}")
         
         # Show system stats
         stats = self.face_service.get_system_stats()
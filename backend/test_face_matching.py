@@ -0,0 +1,55 @@
+# test_face_matching.py
+"""
+Tests for the embedding vector math in face_matching.py. Run from backend/ with `python -m pytest`;
+only numpy is needed, no MongoDB or DeepFace.
+"""
+
+import numpy as np
+import pytest
+
+import face_matching
+from face_matching import unit_rows, cosine_distances
+
+# Facenet embedding size
+DIM = 128
+
+
+def random_unit_rows(count: int, seed: int = 0) -> np.ndarray:
+    return unit_rows(np.random.default_rng(seed).standard_normal((count, DIM)))
+
+
+def test_unit_rows_scales_each_row_to_unit_length():
+    matrix = np.random.default_rng(1).standard_normal((5, DIM)) * 10
+    assert np.allclose(np.linalg.norm(unit_rows(matrix), axis=1), 1.0)
+
+
+def test_unit_rows_accepts_a_single_vector():
+    assert np.allclose(unit_rows(np.array([3.0, 4.0])), [0.6, 0.8])
+
+
+def test_unit_rows_leaves_zero_rows_alone():
+    result = unit_rows(np.array([[0.0, 0.0], [0.0, 2.0]]))
+    assert np.array_equal(result, [[0.0, 0.0], [0.0, 1.0]])
+
+
+def test_cosine_distances_of_same_and_orthogonal_vectors():
+    matrix = np.eye(3, dtype=np.float32)
+    assert np.allclose(cosine_distances(matrix, matrix[0]), [0.0, 1.0, 1.0])
+
+
+def test_cosine_distances_float32_matches_float64():
+    # The gallery is matched in float32; it must agree with a float64 reference to well within match thresholds
+    matrix = random_unit_rows(1000)
+    query = random_unit_rows(1, seed=2)[0]
+    expected = cosine_distances(matrix, query)
+    actual = cosine_distances(matrix.astype(np.float32), query.astype(np.float32))
+    assert actual.dtype == np.float32
+    assert np.abs(actual - expected).max() < 1e-6
+
+
+@pytest.mark.skipif(face_matching.njit is None, reason="numba is not installed")
+def test_numba_kernel_matches_numpy():
+    matrix = random_unit_rows(1000).astype(np.float32)
+    query = random_unit_rows(1, seed=2)[0].astype(np.float32)
+    expected = 1.0 - matrix @ query
+    assert np.abs(face_matching._cosine_distances_kernel(matrix, query) - expected).max() < 1e-6